@@ -0,0 +1,10 @@
+import os
+
+# database settings shared by the api (main.py) and the one-shot migration (migrate.py)
+#  for the sake of the demo, i am exposing the credentials in the docker-compose.yml file
+DB_USER = os.getenv("DB_USER", "user")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
+DB_HOST = os.getenv("DB_HOST", "db")
+DB_PORT = os.getenv("DB_PORT", "5432")
+DB_NAME = os.getenv("DB_NAME", "misprint_db")
+DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
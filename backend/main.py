@@ -1,74 +1,188 @@
 
 import os
 import asyncpg
-from fastapi import FastAPI, HTTPException, Depends, Request
+import orjson
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
 import logging
 import asyncio
+from config import DATABASE_URL
 
 
-#  for the sake of the demo, i am exposing the credentials in the docker-compose.yml file
-DB_USER = os.getenv("DB_USER", "user")
-DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
-DB_HOST = os.getenv("DB_HOST", "db")
-DB_PORT = os.getenv("DB_PORT", "5432")
-DB_NAME = os.getenv("DB_NAME", "misprint_db")
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# pool sizing, keep max size (times the number of workers) below postgres max_connections (100 by default)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "10"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "50"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "5"))
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_CONNECTION_LIFETIME", "60"))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 # real-time Update Mechanism (SSE)
-# this is the point where in future we can use redis pub/sub to broadcast the updates to the frontend
-sse_connections = []
+# these are the clients connected to this worker only. the buy/reset statements publish the new item state
+# through postgres LISTEN/NOTIFY, so every worker/replica hears every update and fans it out to its own clients
+sse_connections: set[asyncio.Queue] = set()
+ITEM_UPDATES_CHANNEL = "item_updates"
+
+# idle sse connections get a comment line this often so proxies don't close them
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", "15"))
+SSE_KEEPALIVE_MESSAGE = b": keepalive\n\n"
+# how often each sse connection checks whether its client is gone
+SSE_DISCONNECT_POLL_INTERVAL = float(os.getenv("SSE_DISCONNECT_POLL_INTERVAL", "1"))
+
+# each client queue is bounded, only the latest item state matters so a slow client just loses old messages
+SSE_MAX_QUEUE_SIZE = int(os.getenv("SSE_MAX_QUEUE_SIZE", "100"))
 
 # database connection pool
 db_pool = None
+# dedicated connection that LISTENs for item updates, kept out of the pool
+db_listener = None
+# pending reconnect after the listener connection dropped, and how long to wait between attempts
+listener_reconnect_task = None
+LISTENER_RECONNECT_DELAY = float(os.getenv("LISTENER_RECONNECT_DELAY", "1"))
+
+# latest known state per item for /status, kept current by on_item_update so polling can skip the database.
+# notifies come from inside the write transactions, so they arrive in commit order and the last one wins.
+# the version bumps on every update so a /status read that raced an update doesn't store the stale row
+item_status_cache: dict[str, dict] = {}
+item_status_version = 0
+
+# the hot queries are prepared once per pooled connection so postgres doesn't re-parse and re-plan them per request
+ITEM_BY_ID_SQL = "SELECT id, name, description, image_url, quantity FROM items WHERE id = $1"
+QUANTITY_BY_ID_SQL = "SELECT quantity FROM items WHERE id = $1"
+# only used to resync clients after the listener reconnects, not worth preparing
+ALL_ITEMS_SQL = "SELECT id, name, description, image_url, quantity FROM items"
+# the order insert rides along in the same statement as the decrement: no extra round-trip, one commit,
+# and a sold unit can never exist without its order row. don't move it into a deferred/batched writer.
+# the NOTIFY is part of the same statement too, postgres only delivers it on commit and in commit order,
+# so listeners never see an update that rolled back or updates out of order
+BUY_ITEM_SQL = f"""
+    WITH upd AS (
+        UPDATE items SET quantity = quantity - 1
+        WHERE id = $1 AND quantity > 0
+        RETURNING id, name, description, image_url, quantity
+    ), ins AS (
+        INSERT INTO orders (item_id) SELECT id FROM upd
+    )
+    SELECT id, name, description, image_url, quantity, pg_notify('{ITEM_UPDATES_CHANNEL}', row_to_json(upd)::text)
+    FROM upd;
+"""
+# restock and clear orders in one statement (one round-trip, implicit transaction). TRUNCATE can't go in a CTE,
+# DELETE is fine for the handful of orders the demo creates. publishes the new state like BUY_ITEM_SQL
+RESET_ITEM_SQL = f"""
+    WITH upd AS (
+        UPDATE items SET quantity = 1
+        WHERE id = $1
+        RETURNING id, name, description, image_url, quantity
+    ), del AS (
+        DELETE FROM orders
+    )
+    SELECT id, name, description, image_url, quantity, pg_notify('{ITEM_UPDATES_CHANNEL}', row_to_json(upd)::text)
+    FROM upd;
+"""
+
+class AppConnection(asyncpg.Connection):
+    # holds the prepared statements for the connection, filled in by prepare_statements
+    item_by_id: asyncpg.prepared_stmt.PreparedStatement
+    quantity_by_id: asyncpg.prepared_stmt.PreparedStatement
+    buy_item: asyncpg.prepared_stmt.PreparedStatement
+    reset_item: asyncpg.prepared_stmt.PreparedStatement
+
+async def prepare_statements(connection: AppConnection):
+    connection.item_by_id = await connection.prepare(ITEM_BY_ID_SQL)
+    connection.quantity_by_id = await connection.prepare(QUANTITY_BY_ID_SQL)
+    connection.buy_item = await connection.prepare(BUY_ITEM_SQL)
+    connection.reset_item = await connection.prepare(RESET_ITEM_SQL)
 
-async def get_db_pool():
+# plain function called by the handlers, cheaper than fastapi dependency resolution on every request
+def get_db_pool() -> asyncpg.Pool:
     if db_pool is None:
         raise HTTPException(status_code=503, detail="Database connection is not available.")
     return db_pool
 
+async def connect_listener():
+    global db_listener
+    connection = await asyncpg.connect(DATABASE_URL)
+    try:
+        await connection.add_listener(ITEM_UPDATES_CHANNEL, on_item_update)
+    except Exception:
+        # don't leak a connection per reconnect attempt
+        await connection.close()
+        raise
+    connection.add_termination_listener(on_listener_terminated)
+    db_listener = connection
+    logger.info(f"Listening for updates on '{ITEM_UPDATES_CHANNEL}'.")
+
+# called by asyncpg when the listener connection drops (postgres restart, network blip).
+# until it is back this worker's sse clients get no updates and the /status cache can't be trusted
+def on_listener_terminated(connection):
+    global listener_reconnect_task, item_status_version
+    logger.error("Update listener connection lost, SSE clients on this worker get no updates until it reconnects.")
+    item_status_cache.clear()
+    # reads that started before the drop may hold a row an unheard update has since replaced
+    item_status_version += 1
+    if listener_reconnect_task is None or listener_reconnect_task.done():
+        listener_reconnect_task = asyncio.create_task(reconnect_listener())
+
+async def reconnect_listener():
+    while True:
+        try:
+            await connect_listener()
+            logger.info("Update listener reconnected.")
+            break
+        except Exception:
+            logger.exception(f"Reconnecting the update listener failed, retrying in {LISTENER_RECONNECT_DELAY}s.")
+            await asyncio.sleep(LISTENER_RECONNECT_DELAY)
+    try:
+        await resync_items()
+    except Exception:
+        logger.exception("Resyncing items after the listener reconnected failed.")
+
+# updates committed while the listener was down were never heard, so push the current state of every item
+# through the normal notify path, which also refills the /status cache
+async def resync_items():
+    while True:
+        version = item_status_version
+        rows = await get_db_pool().fetch(ALL_ITEMS_SQL)
+        # a notify that arrived during the read may be newer than what we read, read again
+        if version == item_status_version:
+            break
+    for row in rows:
+        on_item_update(None, 0, ITEM_UPDATES_CHANNEL, orjson.dumps(dict(row)).decode())
+    logger.info(f"Resynced {len(rows)} items after the listener reconnected.")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global db_pool
     logger.info("Application starting up...")
     try:
-        db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=5, max_size=20)
+        # create_pool opens min_size connections and prepares the statements on each, so a missing schema
+        # (migrate.py not run yet) fails here at startup. each request holds at most one of these connections.
+        db_pool = await asyncpg.create_pool(
+            DATABASE_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+            connection_class=AppConnection, init=prepare_statements,
+        )
         logger.info("Database connection pool created.")
-        async with db_pool.acquire() as connection:
-            await setup_database(connection)
+        await connect_listener()
         yield
     finally:
+        if listener_reconnect_task:
+            listener_reconnect_task.cancel()
+        if db_listener:
+            # a deliberate close, not a drop to reconnect from
+            db_listener.remove_termination_listener(on_listener_terminated)
+            await db_listener.close()
+            logger.info("Update listener closed.")
         if db_pool:
             await db_pool.close()
             logger.info("Database connection pool closed.")
         logger.info("Application shutting down.")
 
-async def setup_database(connection):
-    logger.info("Setting up database schema...")
-    await connection.execute("""
-        CREATE TABLE IF NOT EXISTS items (
-            id TEXT PRIMARY KEY, name TEXT NOT NULL, description TEXT,
-            image_url TEXT, quantity INTEGER NOT NULL CHECK (quantity >= 0)
-        );
-    """)
-    await connection.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            id SERIAL PRIMARY KEY, item_id TEXT NOT NULL, timestamp TIMESTAMPTZ DEFAULT NOW()
-        );
-    """)
-    await connection.execute("""
-        INSERT INTO items (id, name, description, image_url, quantity)
-        VALUES ('charizard-1st-ed', '1st Edition Charizard', 'The holy grail of Pokémon cards. PSA 10 Gem Mint.', 'https://placehold.co/400x600/2D3748/E2E8F0?text=Card', 1)
-        ON CONFLICT (id) DO NOTHING;
-    """)
-    logger.info("Database setup complete.")
-
 app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
@@ -82,84 +196,122 @@ class Item(BaseModel):
 class OrderResponse(BaseModel):
     message: str; item_id: str
 
-# this function is used to broadcast the update to the frontend
-async def broadcast_update(item_id: str):
+# puts a message on one client queue without blocking, a full queue drops its oldest message to make room
+def safe_put(queue: asyncio.Queue, message: bytes):
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        queue.get_nowait()
+        queue.put_nowait(message)
+
+# called by asyncpg for every NOTIFY on the channel, payload is the item json
+def on_item_update(connection, pid, channel, payload: str):
+    global item_status_version
+    item = orjson.loads(payload)
+    item_status_cache[item['id']] = item
+    item_status_version += 1
     if not sse_connections: return
-    logger.info(f"Broadcasting update for item '{item_id}' to {len(sse_connections)} clients.")
-    async with db_pool.acquire() as connection:
-        row = await connection.fetchrow("SELECT * FROM items WHERE id = $1", item_id)
-        if row:
-            item_data = Item(**dict(row)).model_dump_json()
-            message = f"data: {item_data}\n\n"
-            for queue in sse_connections:
-                await queue.put(message)
+    logger.info(f"Broadcasting update to {len(sse_connections)} clients.")
+    # encode once, every client gets a reference to the same message
+    message = b"data: " + payload.encode() + b"\n\n"
+    # puts never block and there is no await in this function, so a fanout can't be interrupted halfway:
+    # every client in the snapshot gets the message
+    for queue in tuple(sse_connections):
+        safe_put(queue, message)
 
 @app.get("/events")
 async def sse_endpoint(request: Request):
     # this is the endpoint that the frontend will connect to for live updates
     from starlette.responses import StreamingResponse
-    queue = asyncio.Queue()
-    sse_connections.append(queue)
+    queue = asyncio.Queue(maxsize=SSE_MAX_QUEUE_SIZE)
+    sse_connections.add(queue)
     logger.info(f"New frontend client connected. Total clients: {len(sse_connections)}")
+    async def watch_disconnect():
+        while not await request.is_disconnected():
+            await asyncio.sleep(SSE_DISCONNECT_POLL_INTERVAL)
+
     async def event_stream():
+        # one pending get is kept across keepalives, waiting with a timeout returns instead of raising,
+        # so idle connections don't cost a TimeoutError per interval
+        get_task = None
+        # don't rely only on starlette cancelling us, a gone client is noticed within a poll interval
+        # and its queue leaves sse_connections so broadcasts stop writing to it
+        watch_task = asyncio.create_task(watch_disconnect())
         try:
             while True:
-                message = await queue.get()
-                yield message
+                if get_task is None:
+                    get_task = asyncio.create_task(queue.get())
+                done, _ = await asyncio.wait(
+                    {get_task, watch_task}, timeout=SSE_KEEPALIVE_INTERVAL, return_when=asyncio.FIRST_COMPLETED,
+                )
+                if watch_task in done:
+                    logger.info("Client disconnected.")
+                    return
+                if get_task in done:
+                    # messages are already encoded, StreamingResponse sends the bytes as-is
+                    message = get_task.result()
+                    get_task = None
+                    yield message
+                else:
+                    yield SSE_KEEPALIVE_MESSAGE
         except asyncio.CancelledError:
             logger.info("Client disconnected.")
         finally:
-            sse_connections.remove(queue)
+            watch_task.cancel()
+            if get_task is not None:
+                get_task.cancel()
+            sse_connections.discard(queue)
             logger.info(f"Client connection removed. Total clients: {len(sse_connections)}")
     return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 @app.get("/status/{item_id}", response_model=Item)
-async def get_item_status(item_id: str, pool: asyncpg.Pool = Depends(get_db_pool)):
+async def get_item_status(item_id: str):
+    # the cache is only trusted while the listener is up, otherwise it could miss updates
+    listening = db_listener is not None and not db_listener.is_closed()
+    if listening and item_id in item_status_cache:
+        return item_status_cache[item_id]
+    pool = get_db_pool()
+    version = item_status_version
     async with pool.acquire() as connection:
-        row = await connection.fetchrow("SELECT * FROM items WHERE id = $1", item_id)
+        row = await connection.item_by_id.fetchrow(item_id)
         if not row: raise HTTPException(status_code=404, detail="Item not found")
-        return Item(**dict(row))
+    item = dict(row)
+    # the listener may have dropped (and even come back) while we were reading, check again
+    listening = db_listener is not None and not db_listener.is_closed()
+    if listening and version == item_status_version:
+        item_status_cache[item_id] = item
+    return item
 
 
 @app.post("/buy/{item_id}", response_model=OrderResponse)
-async def buy_item(item_id: str, pool: asyncpg.Pool = Depends(get_db_pool)):
-    purchase_succeeded = False
+async def buy_item(item_id: str):
+    pool = get_db_pool()
     async with pool.acquire() as connection:
-        # the transaction ensures atomicity. It either all succeeds or all fails.
-        async with connection.transaction():
-            try:
-                item = await connection.fetchrow("SELECT quantity FROM items WHERE id = $1 FOR UPDATE", item_id)
-                if not item:
-                    raise HTTPException(status_code=404, detail="Item not found")
-
-                if item['quantity'] > 0:
-                    await connection.execute("UPDATE items SET quantity = quantity - 1 WHERE id = $1", item_id)
-                    await connection.execute("INSERT INTO orders (item_id) VALUES ($1)", item_id)
-                    # Set a flag that the purchase was successful inside the transaction
-                    purchase_succeeded = True
-                else:
-                    # If quantity is 0, we raise an error which rolls back the transaction
-                    raise HTTPException(status_code=409, detail="Item is sold out")
-            except asyncpg.exceptions.LockNotAvailableError:
-                raise HTTPException(status_code=503, detail="Server is busy, please try again.")
-    
-    
-    # THE FIX IS HERE
-    # we only broadcast the update AFTER the transaction is successfully committed and the lock is released.
-    if purchase_succeeded:
-        await broadcast_update(item_id)
-        return OrderResponse(message="Purchase successful!", item_id=item_id)
-    
-    raise HTTPException(status_code=500, detail="An unexpected error occurred during purchase.")
+        # cheap non-locking check first, once the item is sold out nobody needs to attempt the update
+        current = await connection.quantity_by_id.fetchrow(item_id)
+        if not current:
+            raise HTTPException(status_code=404, detail="Item not found")
+        if current['quantity'] == 0:
+            raise HTTPException(status_code=409, detail="Item is sold out")
+
+        # decrement-if-available and the order insert run as one atomic statement.
+        # postgres re-checks quantity > 0 on the latest row version, so only one buyer can win the last unit
+        # and the losers simply get no row back instead of queueing on a lock.
+        # if this request is cancelled while waiting here the statement may still commit on the server,
+        # the NOTIFY commits with it, so clients get the update either way
+        row = await connection.buy_item.fetchrow(item_id)
+
+    if not row:
+        raise HTTPException(status_code=409, detail="Item is sold out")
+
+    return OrderResponse(message="Purchase successful!", item_id=item_id)
 
 
 @app.post("/reset")
-async def reset_demo(pool: asyncpg.Pool = Depends(get_db_pool)):
+async def reset_demo():
+    pool = get_db_pool()
     item_id = 'charizard-1st-ed'
     async with pool.acquire() as connection:
-        async with connection.transaction():
-            await connection.execute("UPDATE items SET quantity = 1 WHERE id = $1", item_id)
-            await connection.execute("TRUNCATE TABLE orders")
-    
-    await broadcast_update(item_id)
+        await connection.reset_item.fetchrow(item_id)
+
     return {"message": "Demo has been reset successfully."}
@@ -0,0 +1,39 @@
+import asyncio
+import asyncpg
+import logging
+from config import DATABASE_URL
+
+# one-shot schema setup, run once per deploy before the api workers start: python migrate.py
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def setup_database(connection):
+    logger.info("Setting up database schema...")
+    await connection.execute("""
+        CREATE TABLE IF NOT EXISTS items (
+            id TEXT PRIMARY KEY, name TEXT NOT NULL, description TEXT,
+            image_url TEXT, quantity INTEGER NOT NULL CHECK (quantity >= 0)
+        );
+    """)
+    await connection.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id SERIAL PRIMARY KEY, item_id TEXT NOT NULL, timestamp TIMESTAMPTZ DEFAULT NOW()
+        );
+    """)
+    await connection.execute("""
+        INSERT INTO items (id, name, description, image_url, quantity)
+        VALUES ('charizard-1st-ed', '1st Edition Charizard', 'The holy grail of Pokémon cards. PSA 10 Gem Mint.', 'https://placehold.co/400x600/2D3748/E2E8F0?text=Card', 1)
+        ON CONFLICT (id) DO NOTHING;
+    """)
+    logger.info("Database setup complete.")
+
+async def migrate():
+    connection = await asyncpg.connect(DATABASE_URL)
+    try:
+        await setup_database(connection)
+    finally:
+        await connection.close()
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
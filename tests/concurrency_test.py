@@ -10,12 +10,16 @@ STATUS_URL = f"{API_BASE_URL}/status/{ITEM_ID}"
 PURCHASE_URL = f"{API_BASE_URL}/buy/{ITEM_ID}"
 RESET_URL = f"{API_BASE_URL}/reset"
 NUM_REQUESTS = 100
+# enough pooled connections for every request to be in flight at once, so the timings measure the backend
+# and not requests queueing for a client socket
+CLIENT_LIMITS = httpx.Limits(max_connections=NUM_REQUESTS * 2, max_keepalive_connections=NUM_REQUESTS * 2)
+CLIENT_TIMEOUT = httpx.Timeout(15.0)
 
 # makes a single asynchronous request to the /buy endpoint.
 async def make_purchase_request(client: httpx.AsyncClient):
   
     try:
-        response = await client.post(PURCHASE_URL, timeout=15.0)
+        response = await client.post(PURCHASE_URL)
         return response.status_code
     except Exception as e:
         print(f"A request failed: {e}")
@@ -24,7 +28,7 @@ async def make_purchase_request(client: httpx.AsyncClient):
 async def main():
     print(f"\nConcurrency Test")
       # check current state and reset if necessary
-    async with httpx.AsyncClient() as client:
+    async with httpx.AsyncClient(limits=CLIENT_LIMITS, timeout=CLIENT_TIMEOUT) as client:
         print(f"\n1. Checking current item status")
         try:
             status_response = await client.get(STATUS_URL)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the backend is not a package, it runs from its own directory (/app in the image)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
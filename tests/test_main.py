@@ -0,0 +1,203 @@
+import asyncio
+import orjson
+import pytest
+import main
+
+
+ITEM = {"id": "charizard-1st-ed", "name": "1st Edition Charizard", "description": "PSA 10",
+        "image_url": "https://placehold.co/400x600", "quantity": 1}
+
+
+class FakeListener:
+    def __init__(self, closed=False):
+        self.closed = closed
+
+    def is_closed(self):
+        return self.closed
+
+
+class FakeStatement:
+    def __init__(self, row, during_read=None):
+        self.row = row
+        self.during_read = during_read
+
+    async def fetchrow(self, item_id):
+        if self.during_read:
+            self.during_read()
+        return self.row
+
+
+class FakeConnection:
+    def __init__(self, statement):
+        self.item_by_id = statement
+
+
+class FakeAcquire:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def __aenter__(self):
+        return self.connection
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakePool:
+    def __init__(self, statement, rows=(), during_fetch=None):
+        self.statement = statement
+        self.rows = rows
+        self.during_fetch = during_fetch
+        self.reads = 0
+
+    def acquire(self):
+        self.reads += 1
+        return FakeAcquire(FakeConnection(self.statement))
+
+    async def fetch(self, sql):
+        self.reads += 1
+        if self.during_fetch:
+            self.during_fetch()
+            self.during_fetch = None
+        return list(self.rows)
+
+
+class FailingListenerConnection:
+    def __init__(self):
+        self.closed = False
+
+    async def add_listener(self, channel, callback):
+        raise OSError("connection reset")
+
+    async def close(self):
+        self.closed = True
+
+
+def notify(item):
+    main.on_item_update(None, 0, main.ITEM_UPDATES_CHANNEL, orjson.dumps(item).decode())
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(main, "item_status_cache", {})
+    monkeypatch.setattr(main, "item_status_version", 0)
+    monkeypatch.setattr(main, "sse_connections", set())
+    monkeypatch.setattr(main, "db_listener", FakeListener())
+
+
+def test_notify_updates_cache_and_version():
+    notify(ITEM)
+    notify({**ITEM, "quantity": 0})
+    assert main.item_status_cache[ITEM["id"]]["quantity"] == 0
+    assert main.item_status_version == 2
+
+
+def test_status_served_from_cache(monkeypatch):
+    pool = FakePool(FakeStatement(ITEM))
+    monkeypatch.setattr(main, "db_pool", pool)
+    notify({**ITEM, "quantity": 0})
+    assert asyncio.run(main.get_item_status(ITEM["id"]))["quantity"] == 0
+    assert pool.reads == 0
+
+
+def test_status_read_fills_cache(monkeypatch):
+    pool = FakePool(FakeStatement(ITEM))
+    monkeypatch.setattr(main, "db_pool", pool)
+    asyncio.run(main.get_item_status(ITEM["id"]))
+    asyncio.run(main.get_item_status(ITEM["id"]))
+    assert pool.reads == 1
+    assert main.item_status_cache[ITEM["id"]] == ITEM
+
+
+def test_status_read_racing_a_notify_does_not_store_stale_row(monkeypatch):
+    # the db read returns quantity 1, but a purchase is published while it is in flight
+    statement = FakeStatement(ITEM, during_read=lambda: notify({**ITEM, "quantity": 0}))
+    monkeypatch.setattr(main, "db_pool", FakePool(statement))
+    asyncio.run(main.get_item_status(ITEM["id"]))
+    assert main.item_status_cache[ITEM["id"]]["quantity"] == 0
+
+
+def test_status_read_racing_a_listener_drop_does_not_store_stale_row(monkeypatch):
+    async def reconnect_listener():
+        pass
+    monkeypatch.setattr(main, "reconnect_listener", reconnect_listener)
+    monkeypatch.setattr(main, "listener_reconnect_task", None)
+
+    # the listener drops while the db read is in flight and is back before the read returns,
+    # any update committed in between was never heard
+    def drop_and_reconnect():
+        main.db_listener.closed = True
+        main.on_listener_terminated(main.db_listener)
+        main.db_listener = FakeListener()
+
+    statement = FakeStatement(ITEM, during_read=drop_and_reconnect)
+    monkeypatch.setattr(main, "db_pool", FakePool(statement))
+    asyncio.run(main.get_item_status(ITEM["id"]))
+    assert ITEM["id"] not in main.item_status_cache
+
+def test_cache_bypassed_while_listener_is_down(monkeypatch):
+    pool = FakePool(FakeStatement(ITEM))
+    monkeypatch.setattr(main, "db_pool", pool)
+    monkeypatch.setattr(main, "db_listener", FakeListener(closed=True))
+    main.item_status_cache[ITEM["id"]] = {**ITEM, "quantity": 0}
+    assert asyncio.run(main.get_item_status(ITEM["id"]))["quantity"] == 1
+    assert pool.reads == 1
+    assert main.item_status_cache[ITEM["id"]]["quantity"] == 0
+
+
+def test_listener_drop_clears_cache(monkeypatch):
+    async def reconnect_listener():
+        pass
+    monkeypatch.setattr(main, "reconnect_listener", reconnect_listener)
+    monkeypatch.setattr(main, "listener_reconnect_task", None)
+    notify(ITEM)
+
+    async def drop():
+        main.on_listener_terminated(None)
+        await main.listener_reconnect_task
+
+    asyncio.run(drop())
+    assert main.item_status_cache == {}
+
+
+def test_full_queue_keeps_newest_messages():
+    queue = asyncio.Queue(maxsize=main.SSE_MAX_QUEUE_SIZE)
+    for i in range(main.SSE_MAX_QUEUE_SIZE + 5):
+        main.safe_put(queue, str(i).encode())
+    kept = [queue.get_nowait() for _ in range(queue.qsize())]
+    assert kept == [str(i).encode() for i in range(5, main.SSE_MAX_QUEUE_SIZE + 5)]
+
+
+def test_notify_fans_out_to_every_client(monkeypatch):
+    queues = {asyncio.Queue(maxsize=2) for _ in range(3)}
+    monkeypatch.setattr(main, "sse_connections", queues)
+    notify(ITEM)
+    for queue in queues:
+        assert queue.get_nowait() == b"data: " + orjson.dumps(ITEM) + b"\n\n"
+
+
+def test_failed_add_listener_closes_the_connection(monkeypatch):
+    connection = FailingListenerConnection()
+
+    async def connect(url):
+        return connection
+    monkeypatch.setattr(main.asyncpg, "connect", connect)
+    with pytest.raises(OSError):
+        asyncio.run(main.connect_listener())
+    assert connection.closed
+
+
+def test_resync_pushes_current_state_to_clients_and_cache(monkeypatch):
+    queue = asyncio.Queue(maxsize=2)
+    monkeypatch.setattr(main, "sse_connections", {queue})
+    monkeypatch.setattr(main, "db_pool", FakePool(None, rows=[{**ITEM, "quantity": 0}]))
+    asyncio.run(main.resync_items())
+    assert main.item_status_cache[ITEM["id"]]["quantity"] == 0
+    assert queue.get_nowait() == b"data: " + orjson.dumps({**ITEM, "quantity": 0}) + b"\n\n"
+
+
+def test_resync_rereads_when_a_notify_lands_during_the_read(monkeypatch):
+    pool = FakePool(None, rows=[ITEM], during_fetch=lambda: notify({**ITEM, "quantity": 0}))
+    monkeypatch.setattr(main, "db_pool", pool)
+    asyncio.run(main.resync_items())
+    assert pool.reads == 2